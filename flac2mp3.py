@@ -18,20 +18,68 @@ with FLACs.
 """
 
 import os
+import functools
+import shlex
 import subprocess
-import mimetypes
+import multiprocessing
 from pathlib import Path
-from shutil import copytree, ignore_patterns
-from argparse import ArgumentParser
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from shutil import copy2, copytree, ignore_patterns
+from argparse import ArgumentParser, ArgumentTypeError
 from sys import stdout
+from tinytag import TinyTag
 from mutagen.flac import FLAC
 from mutagen.easyid3 import EasyID3
-# pylint: disable=no-name-in-module
-# noinspection PyUnresolvedReferences
-from mutagen.id3 import ID3, Encoding, PictureType, APIC
 # pylint: disable=no-member
 from colorama import Fore, Style, init as colorama_init
 
+# output lock shared by worker processes, set by _init_worker
+_OUTPUT_LOCK = None
+# lines of a track being recoded by a worker, see _track_output
+_OUTPUT_BUFFER = None
+
+
+def _init_worker(lock):
+    """ Worker process initializer, keeps output lock for echoing """
+    global _OUTPUT_LOCK  # pylint: disable=global-statement
+    _OUTPUT_LOCK = lock
+    # spawned workers do not inherit colorama stdout wrapping
+    colorama_init()
+
+
+def _echo(*args):
+    """ Print a line, or collect it for the current worker track """
+    if _OUTPUT_BUFFER is None:
+        print(*args)
+    else:
+        _OUTPUT_BUFFER.append(' '.join(str(arg) for arg in args))
+
+
+@contextmanager
+def _track_output():
+    """ Write worker output of one track at once, not interleaved with others """
+    global _OUTPUT_BUFFER  # pylint: disable=global-statement
+    if _OUTPUT_LOCK is None:
+        yield
+        return
+    _OUTPUT_BUFFER = []
+    try:
+        yield
+    finally:
+        lines, _OUTPUT_BUFFER = _OUTPUT_BUFFER, None
+        with _OUTPUT_LOCK:
+            print('\n'.join(lines), flush=True)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_flac(flac_path):
+    """ Parse FLAC metadata, the last parse is kept for a following read
+    Only the last one, parsed FLACs may hold large picture blocks
+    """
+    return FLAC(flac_path)
+
 
 class Taginfo:
     """ Taginfo class
@@ -39,10 +87,10 @@ class Taginfo:
     """
 
     def __init__(self, flac_path):
-        self.flac = FLAC(flac_path)
+        self.flac = _load_flac(flac_path)
         # cache for flac keys, normalized and deduplicated
-        self.flac_keys = [key.upper() for [key, _] in
-                          self.flac.tags if len(self.flac[key][0].strip()) > 0]
+        # a key counts only if its first value is non-empty, consume() reads that one
+        self.flac_keys = {key.upper() for key in self.flac.keys() if self.flac[key][0].strip()}
         if ('ALBUM ARTIST' in self.flac_keys and
                 'ALBUMARTIST' in self.flac_keys and
                 self.flac['ALBUM ARTIST'] == self.flac['ALBUMARTIST']):
@@ -61,15 +109,7 @@ class Taginfo:
 
     def has(self, key):
         """ Accessor for flac key """
-        if key in self.flac_keys:
-            return key is not None and key != ''
-        return False
-
-    def get_discnumber(self):
-        """ Extract discnumber or 1 if missing """
-        if self.has('DISCNUMBER'):
-            return int(self.consume('DISCNUMBER'))
-        return 1
+        return key in self.flac_keys
 
     def get_release_dir_name(self, mp3_mode):
         """ Compose a directory name for specific mp3_mode (V0 or 320) """
@@ -112,7 +152,7 @@ class Retagger(Taginfo):
         # set disc number only if multiple discs
         if (self.multidisc and ('DISCNUMBER' in self.flac_keys) and
                 ('DISCTOTAL' in self.flac_keys or 'TOTALDISCS' in self.flac_keys)):
-            print('Setting disc number')
+            _echo('Setting disc number')
             if 'DISCTOTAL' in self.flac_keys:
                 self.id3['discnumber'] = '/'.join([self.consume('DISCNUMBER'),
                                                    self.consume('DISCTOTAL')])
@@ -122,9 +162,7 @@ class Retagger(Taginfo):
 
         # drop discs stuff at all if not multidisc
         if not self.multidisc:
-            for drop in ['DISCNUMBER', 'TOTALDISCS', 'DISCTOTAL']:
-                if drop in self.flac_keys:
-                    self.flac_keys.remove(drop)
+            self.flac_keys -= {'DISCNUMBER', 'TOTALDISCS', 'DISCTOTAL'}
 
     def retag(self):
         """ Perform tagging """
@@ -146,20 +184,21 @@ class Retagger(Taginfo):
                 self.consume(key)
 
         # check for known remaining tags
-        for key in self.flac_keys[:]:
-            if key.lower() in EasyID3.valid_keys.keys():
-                print('Adding known tag: %s=%s' % (key, self.flac[key]))
+        valid_keys = frozenset(EasyID3.valid_keys)
+        for key in sorted(self.flac_keys):
+            if key.lower() in valid_keys:
+                _echo('Adding known tag: %s=%s' % (key, self.flac[key]))
                 self.id3[key] = self.consume(key)
 
         # add remaining keys to TXXX frames
-        for key in self.flac_keys[:]:
-            print('Adding custom tag: %s=%s' % (key, self.flac[key]))
+        for key in sorted(self.flac_keys):
+            _echo('Adding custom tag: %s=%s' % (key, self.flac[key]))
             EasyID3.RegisterTXXXKey(key, key)
             self.id3[key] = self.consume(key)
 
         self.id3.save(v2_version=3)
         if self.verbose:
-            print('Tags written')
+            _echo('Tags written')
 
 
 class Recoder:
@@ -173,24 +212,19 @@ class Recoder:
     def recode_dir(self, path):
         """ Mode: recode a dir inplace """
         # Enumerate flacs
-        flacs = sorted([x for x in Path(path).iterdir() if x.suffix == '.flac'])
+        flacs = self.__list_files(path, '.flac')
         is_multidisc = self.__get_multidisc(list(flacs))
-        if [x for x in flacs if str(x).count('"') > 0]:
-            raise Exception('Quotes in names, cannot continue')
         image_path = self.__find_and_trace_image(path)
         # Finally recode
-        for idx, flac in enumerate(flacs):
-            mp3 = flac.with_suffix('.mp3')
-            self.__recode_file_impl(flac, mp3, idx, len(flacs), is_multidisc, image_path)
+        self.__recode_files([(flac, flac.with_suffix('.mp3')) for flac in flacs],
+                            is_multidisc, image_path)
 
     def recode_new_dir(self, path, target):
         """ Mode: recode a dir to a new dir with a proper name """
 
         # Enumerate flacs
-        flacs = sorted([x for x in Path(path).iterdir() if x.suffix == '.flac'])
+        flacs = self.__list_files(path, '.flac')
         is_multidisc = self.__get_multidisc(list(flacs))
-        if [x for x in flacs if str(x).count('"') > 0]:
-            raise Exception('Quotes in names, cannot continue')
         # Compose new name
         if self.flags.vbr:
             mode_str = 'V0'
@@ -202,36 +236,94 @@ class Recoder:
             target_parent_path = Path(target).expanduser().resolve()
         else:
             target_parent_path = Path(path).resolve().parent
-        new_path = target_parent_path / Path(Taginfo(str(flacs[0])).
-                                             get_release_dir_name(mode_str))
+        # parse is cached by _load_flac and reused when retagging the first track,
+        # in-process or by a forked worker; spawned workers parse it again
+        first_tag = Taginfo(str(flacs[0]))
+        new_path = target_parent_path / Path(first_tag.get_release_dir_name(mode_str))
         if new_path.is_dir():
             raise Exception('Target already exists: %s' % new_path)
         print("New path is %s" % str(new_path))
         # Copy artwork, cues etc
-        copytree(str(path), str(new_path), ignore=ignore_patterns('*.flac'))
-        print("Copied %s files and dirs" % len(list(Path(new_path).iterdir())))
+        copied = []
+
+        def copy_and_count(src, dst):
+            copied.append(src)
+            return copy2(src, dst)
+
+        copytree(str(path), str(new_path), ignore=ignore_patterns('*.flac'),
+                 copy_function=copy_and_count)
+        print("Copied %s files" % len(copied))
 
         image_path = self.__find_and_trace_image(new_path)
         # Finally recode
-        for idx, flac in enumerate(flacs):
-            mp3 = new_path / flac.with_suffix('.mp3').name
-            self.__recode_file_impl(flac, mp3, idx, len(flacs), is_multidisc, image_path)
+        self.__recode_files([(flac, new_path / flac.with_suffix('.mp3').name) for flac in flacs],
+                            is_multidisc, image_path)
 
     def recode_file(self, flac):
         """ Mode: recode a file """
         mp3 = Path(flac).with_suffix('.mp3')
-        self.__recode_file_impl(Path(flac), mp3, None, False, None, None)
+        # no track count for a single file, keep track total from tags only
+        self._recode_file_impl(Path(flac), mp3, 0, None, 1, False, None)
+
+    def __recode_files(self, pairs, multidisc, image_path):
+        """ Recode (flac, mp3) pairs, in parallel if more than one job """
+        count = len(pairs)
+        width = len(str(count))
+        jobs = self.flags.jobs
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        if jobs == 1 or count == 1:
+            for idx, (flac, mp3) in enumerate(pairs):
+                self._recode_file_impl(flac, mp3, idx, count, width, multidisc, image_path)
+            return
+        lock = multiprocessing.Lock()
+        workers = min(jobs, count)
+        tasks = iter(enumerate(pairs))
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker, initargs=(lock,)) as executor:
+            # submit lazily so nothing new starts after a failed track,
+            # queued executor calls cannot be cancelled
+            running = set()
+            for idx, (flac, mp3) in islice(tasks, workers):
+                running.add(executor.submit(self._recode_file_impl, flac, mp3,
+                                            idx, count, width, multidisc, image_path))
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    # re-raise worker exception, running tracks are finished
+                    future.result()
+                for idx, (flac, mp3) in islice(tasks, len(done)):
+                    running.add(executor.submit(self._recode_file_impl, flac, mp3,
+                                                idx, count, width, multidisc, image_path))
 
     def __find_and_trace_image(self, new_path):
         image_path = self.__find_image(new_path)
         if image_path:
             print("Using image " + image_path.name)
-            cmd = "identify -format '%%m %%wx%%h %%[bit-depth]-bit %%[colorspace]' \"%s\"" % image_path
-            print("Image identify: " + subprocess.check_output(cmd, shell=True).decode('utf-8'))
+            cmd = ['identify', '-format', '%m %wx%h %[bit-depth]-bit %[colorspace]', str(image_path)]
+            print("Image identify: " + subprocess.check_output(cmd).decode('utf-8'))
+            if not self.__is_lame_image(image_path):
+                # lame --ti aborts encoding on other formats
+                print(Fore.YELLOW + 'Image is not JPEG/PNG/GIF, not embedding' + Style.RESET_ALL)
+                image_path = None
         else:
             print(Fore.YELLOW + 'No image' + Style.RESET_ALL)
         return image_path
 
+    @staticmethod
+    def __is_lame_image(image_path):
+        """ Check image magic for formats accepted by lame --ti """
+        with open(str(image_path), 'rb') as image_io:
+            magic = image_io.read(8)
+        return magic.startswith((b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF8'))
+
+    @staticmethod
+    def __list_files(path, suffix):
+        """ Sorted files with a suffix in a dir (non-recursive) """
+        with os.scandir(str(path)) as entries:
+            return sorted(Path(entry.path) for entry in entries
+                          if entry.name.endswith(suffix) and entry.is_file())
+
     @staticmethod
     def __find_image(rootdir):
         for name in ['folder.jpg', 'Folder.jpg', 'cover.jpg', 'Cover.jpg']:
@@ -239,44 +331,26 @@ class Recoder:
             if image_path.exists():
                 return image_path
         # find any other jpg in directory (non-recursive). if it is only one jpg, use it
-        other_jpgs = [x for x in Path(rootdir).iterdir() if x.is_file() and x.suffix == '.jpg']
+        other_jpgs = Recoder.__list_files(rootdir, '.jpg')
         if len(other_jpgs) == 1:
             return other_jpgs[0]
         return None
 
-    def __recode_file_impl(self, flac, mp3, idx, count, multidisc, image_path):
-        """ Recode file, set tags and image """
-        width = (count // 10) + 1
-        print("{}--- [{:0{}d}/{:0{}d}] {}{}".format(Fore.GREEN, idx+1, width, count, width, str(flac), Style.RESET_ALL))
-        self.__recode_to_mp3(flac, mp3)
-        retagger = Retagger(str(flac), str(mp3), count, multidisc, self.flags.verbose)
-        retagger.retag()
-        if image_path:
-            self.__set_image(mp3, image_path)
-        self.__post_check(mp3)
+    def _recode_file_impl(self, flac, mp3, idx, count, width, multidisc, image_path):
+        """ Recode file, set tags and image
+        Not name-mangled to be picklable as a worker task
+        """
+        with _track_output():
+            _echo(f"{Fore.GREEN}--- [{idx+1:0{width}d}/{count or 1:0{width}d}] {flac}{Style.RESET_ALL}")
+            self.__recode_to_mp3(flac, mp3, image_path)
+            retagger = Retagger(str(flac), str(mp3), count, multidisc, self.flags.verbose)
+            retagger.retag()
+            self.__post_check(mp3)
 
     @staticmethod
     def __get_multidisc(flac_pathes):
-        return max([Taginfo(str(flac_path)).get_discnumber() for flac_path in flac_pathes]) > 1
-
-    def __set_image(self, mp3, image_path):
-        """ Set image to MP3 tag from file """
-        with open(str(image_path), "rb") as image_io:
-            data = image_io.read()
-        mime = mimetypes.guess_type(str(image_path))[0] or "image/jpeg"
-        frame = APIC(encoding=Encoding.UTF8, mime=mime,
-                     desc=u"cover", type=PictureType.COVER_FRONT,
-                     data=data)
-
-        id3tag = ID3(str(mp3), v2_version=3)
-        id3tag.add(frame)
-        id3tag.save(v2_version=3)
-        if self.flags.verbose:
-            print('Images written')
-
-    @staticmethod
-    def __escape_path(s):
-        return s.replace('`', '\\`')
+        # tinytag reads disc number without loading picture blocks
+        return max([int(TinyTag.get(str(flac_path)).disc or 1) for flac_path in flac_pathes]) > 1
 
     @staticmethod
     def __post_check(mp3):
@@ -284,9 +358,18 @@ class Recoder:
         id3tag = EasyID3(str(mp3))
         for tag in ['artist', 'album', 'title', 'genre', 'date']:
             if tag not in id3tag:
-                print(Fore.RED + 'No essential tag found: ' + tag + Style.RESET_ALL)
-
-    def __recode_to_mp3(self, flac, mp3):
+                _echo(Fore.RED + 'No essential tag found: ' + tag + Style.RESET_ALL)
+
+    def __priority_kwargs(self):
+        """ Popen arguments lowering flac and lame priority by --nice """
+        niceness = self.flags.nice
+        if niceness <= 0:
+            return {}
+        if os.name == 'nt':
+            return {'creationflags': subprocess.BELOW_NORMAL_PRIORITY_CLASS}
+        return {'preexec_fn': lambda: os.nice(niceness)}
+
+    def __recode_to_mp3(self, flac, mp3, image_path):
         """ Recode from FLAC to MP3 """
         if flac.suffix != '.flac':
             raise Exception('Wrong path')
@@ -295,39 +378,70 @@ class Recoder:
                 mp3.unlink()
             else:
                 raise Exception('Path %s already exists' % mp3)
-        # encode
-        tmp_wav = (mp3.parent / "tmp.wav")
-        wav_path = str(tmp_wav)
-        flac_path = str(flac)
-        mp3_path = str(mp3)
+        # decode to stdout and encode from stdin without a temporary wav
+        lame_settings = ''
+        if self.flags.vbr:
+            lame_settings = '-V 0 --vbr-new'
+        elif self.flags.cbr:
+            lame_settings = '-b 320'
+        elif self.flags.mode:
+            lame_settings = self.flags.mode
+        decode_cmd = ['flac', '-d', '-c', '--silent', str(flac)]
+        encode_cmd = (['lame', '--silent', '-q', '0'] + shlex.split(lame_settings) +
+                      ['--add-id3v2', '--id3v2-only'])
+        if image_path:
+            # LAME embeds the cover itself, no extra ID3 rewrite needed
+            encode_cmd += ['--ti', str(image_path)]
+        encode_cmd += ['-', str(mp3)]
+        if self.flags.verbose:
+            _echo('Decoding: %s' % ' '.join(decode_cmd))
+            _echo('Encoding: %s' % ' '.join(encode_cmd))
+        decoder = None
         try:
-            cmd = "flac \"%s\" -d --silent --force -o \"%s\"" % (flac_path, wav_path)
-            cmd = self.__escape_path(cmd)
-            if self.flags.verbose:
-                print('Decoding: %s' % cmd)
-            subprocess.check_call(cmd, shell=True)
-            lame_settings = ''
-            if self.flags.vbr:
-                lame_settings = '-V 0 --vbr-new'
-            elif self.flags.cbr:
-                lame_settings = '-b 320'
-            elif self.flags.mode:
-                lame_settings = self.flags.mode
-            cmd = "lame --silent -q 0 \"%s\" --add-id3v2 --id3v2-only \"%s\" \"%s\"" % \
-                  (lame_settings, wav_path, mp3_path)
-            cmd = self.__escape_path(cmd)
-            if self.flags.verbose:
-                print('Encoding: %s' % cmd)
-            subprocess.check_call(cmd, shell=True)
-            tmp_wav.unlink()
+            decoder = subprocess.Popen(decode_cmd, stdout=subprocess.PIPE,
+                                       **self.__priority_kwargs())
+            encoder = subprocess.Popen(encode_cmd, stdin=decoder.stdout,
+                                       **self.__priority_kwargs())
+            # let decoder receive SIGPIPE if encoder exits
+            decoder.stdout.close()
+            encoder.wait()
+            decoder.wait()
+            # encoder failure kills decoder by SIGPIPE, so report encoder first
+            if encoder.returncode != 0:
+                raise subprocess.CalledProcessError(encoder.returncode, encode_cmd)
+            if decoder.returncode != 0:
+                raise subprocess.CalledProcessError(decoder.returncode, decode_cmd)
         except Exception:  # pylint: disable=broad-except
+            if decoder is not None and decoder.poll() is None:
+                decoder.stdout.close()
+                decoder.kill()
+                decoder.wait()
             if mp3.exists():
                 mp3.unlink()
-            if tmp_wav.exists():
-                tmp_wav.unlink()
             raise
 
 
+def _int_at_least(value, minimum, description):
+    """ Parse an integer argument not less than minimum """
+    try:
+        number = int(value)
+    except ValueError:
+        raise ArgumentTypeError('%s is not %s' % (value, description)) from None
+    if number < minimum:
+        raise ArgumentTypeError('%s is not %s' % (value, description))
+    return number
+
+
+def _positive_int(value):
+    """ Argparse type for a positive integer """
+    return _int_at_least(value, 1, 'a positive integer')
+
+
+def _non_negative_int(value):
+    """ Argparse type for a non-negative integer """
+    return _int_at_least(value, 0, 'a non-negative integer')
+
+
 def main():
     """ Entry point """
     colorama_init()
@@ -341,6 +455,10 @@ def main():
     parser.add_argument('--force', '-f', action='store_true', help='Overwrite mp3')
     parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
     parser.add_argument('--beep', '-b', action='store_true', help='Beep')
+    parser.add_argument('--jobs', '-j', type=_positive_int, default=None,
+                        help='Parallel encode jobs (default: CPU count)')
+    parser.add_argument('--nice', '-n', type=_non_negative_int, default=0,
+                        help='Niceness increment for flac and lame processes')
     parser.add_argument('path', help='Directory or file path')
     flags = parser.parse_args()
 